@@ -1,29 +1,31 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import gzip
 import imaplib
-import re
+import multiprocessing
+import os
 import time
 import tomllib
-import xml.etree.ElementTree as ET
 import zipfile
 from email import policy
 from email.parser import BytesParser
 from io import BytesIO
 from pathlib import Path
 
-from prometheus_client import start_http_server, Gauge
+import lxml.etree as ET
+from prometheus_client import start_http_server, Counter, Gauge
 
 
 # Define Prometheus metrics with labels (domain, provider, report_id, report_date)
-dmarc_passed = Gauge(
-    'dmarc_passed_count',
+dmarc_passed = Counter(
+    'dmarc_passed_total',
     'Number of emails that passed DMARC',
     ['domain', 'provider', 'report_id', 'report_date']
 )
-dmarc_failed = Gauge(
-    'dmarc_failed_count',
+dmarc_failed = Counter(
+    'dmarc_failed_total',
     'Number of emails that failed DMARC',
     ['domain', 'provider', 'report_id', 'report_date']
 )
@@ -33,6 +35,21 @@ dmarc_last_processed_timestamp_seconds = Gauge(
     ['domain', 'provider', 'report_id', 'report_date']
 )
 
+# Report sections picked out while stream-parsing, in any namespace
+REPORT_TAGS = ('{*}report_metadata', '{*}policy_published', '{*}record')
+
+# Policy dispositions counted as passing DMARC
+PASSED_DISPOSITIONS = frozenset({'none', 'quarantine'})
+
+# Maximum number of messages requested per IMAP FETCH command
+FETCH_BATCH_SIZE = 100
+
+# Seconds to wait on any IMAP read or write before treating the connection as dead
+IMAP_TIMEOUT = 60
+
+# Servers may drop IDLE after 30 minutes (RFC 2177), so re-issue it before then
+IDLE_TIMEOUT = 29 * 60
+
 ARGPARSER = argparse.ArgumentParser(
     description="Fetch, parse, and export Prometheus metrics from DMARC mail."
 )
@@ -43,121 +60,348 @@ ARGS = ARGPARSER.parse_args()
 with open(Path(ARGS.config), "rb") as f:
     CONFIG = tomllib.load(f)
 
+# Fall back to the environment for email settings missing from the config file
+for key, env_var in (("username", "EMAIL_USER"),
+                     ("password", "EMAIL_PASSWORD"),
+                     ("imap_server", "IMAP_SERVER")):
+    if env_var in os.environ:
+        CONFIG.setdefault("email", {}).setdefault(key, os.environ[env_var])
 
-def get_email_attachments():
-    """Connects to an email inbox and retrieves DMARC report attachments."""
-    attachments = []
 
+def connect_mailbox():
+    """Logs in to the email inbox and selects the DMARC report folder."""
+    mail = imaplib.IMAP4_SSL(CONFIG["email"]["imap_server"], timeout=IMAP_TIMEOUT)
     try:
-        mail = imaplib.IMAP4_SSL(CONFIG["email"]["imap_server"])
         mail.login(CONFIG["email"]["username"], CONFIG["email"]["password"])
         mail.select(CONFIG["email"].get("folder", "INBOX"))
+    except Exception:
+        close_mailbox(mail)
+        raise
+
+    return mail
+
+def close_mailbox(mail):
+    """Logs out of an IMAP connection, tolerating one that has already dropped."""
+    if mail is None:
+        return
+
+    try:
+        mail.logout()
+    except (imaplib.IMAP4.error, OSError):
+        pass
 
-        # Search for unread emails with attachments
-        result, data = mail.search(None, '(UNSEEN)')
+def supports_idle(mail):
+    """Checks whether the IMAP server advertises the IDLE capability."""
+    result, data = mail.capability()
 
-        if result == 'OK':
-            for num in data[0].split():
-                result, msg_data = mail.fetch(num, '(RFC822)')
-                if result != 'OK':
+    return result == 'OK' and b'IDLE' in data[0].upper().split()
+
+def _announces_new_mail(line):
+    """Checks whether an IMAP response line is an untagged EXISTS."""
+    return line.startswith(b'* ') and line.rstrip().endswith(b'EXISTS')
+
+def wait_for_mail(mail, timeout):
+    """Blocks in IMAP IDLE until the server announces new mail or the timeout elapses.
+
+    Returns False if the server rejected IDLE, in which case nothing was waited for.
+    """
+    # imaplib has no idle() before Python 3.14, so IDLE is driven by hand. This
+    # relies on CPython 3.11 imaplib internals, as pinned in the Dockerfile:
+    # _new_tag() and tagged_commands for the command tag, and the buffered
+    # socket file in mail.file.
+    tag = mail._new_tag()
+    try:
+        mail.send(tag + b' IDLE\r\n')
+
+        # Untagged data such as EXISTS may arrive before the continuation. Only the
+        # command's tagged completion means IDLE was rejected, and since it ends
+        # the command the connection stays usable.
+        new_mail = False
+        while True:
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("Connection closed during IDLE")
+            if line.startswith(b'+'):
+                break
+            if line.startswith(tag + b' '):
+                print(f"IDLE rejected: {line.decode(errors='replace').strip()}. Falling back to polling")
+                return False
+            if _announces_new_mail(line):
+                new_mail = True
+
+        deadline = time.monotonic() + timeout
+        previous_timeout = mail.sock.gettimeout()
+        try:
+            while not new_mail:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                # Read through imaplib's buffered file so lines that arrived
+                # together with the continuation are not missed
+                mail.sock.settimeout(remaining)
+                try:
+                    line = mail.readline()
+                except TimeoutError:
+                    # A timed out socket file refuses further reads; nothing was
+                    # consumed, so replace it with a fresh one
+                    mail.file.close()
+                    mail.file = mail.sock.makefile('rb')
+                    break
+
+                if not line:
+                    raise imaplib.IMAP4.abort("Connection closed during IDLE")
+                new_mail = _announces_new_mail(line)
+        finally:
+            mail.sock.settimeout(previous_timeout)
+
+        # End IDLE and discard any untagged responses until it completes
+        mail.send(b'DONE\r\n')
+        while True:
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("Connection closed during IDLE")
+            if line.startswith(tag + b' '):
+                break
+
+        return True
+    finally:
+        # _new_tag() registers the tag, but only imaplib's own command
+        # handling would ever remove it
+        mail.tagged_commands.pop(tag, None)
+
+def get_email_attachments(mail):
+    """Retrieves DMARC report attachments from unread mail on an open connection."""
+    attachments = []
+
+    # Search for unread emails with attachments
+    result, data = mail.search(None, '(UNSEEN)')
+
+    if result == 'OK':
+        ids = data[0].split()
+
+        # Fetch in batches to save round-trips without exceeding
+        # server command length limits
+        for i in range(0, len(ids), FETCH_BATCH_SIZE):
+            batch = b','.join(ids[i:i + FETCH_BATCH_SIZE])
+            result, msg_data = mail.fetch(batch, '(RFC822)')
+            if result != 'OK':
+                continue
+
+            # Each message arrives as a (header, body) tuple followed by b')'
+            for item in msg_data:
+                if not isinstance(item, tuple):
                     continue
 
-                msg = BytesParser(policy=policy.default).parsebytes(msg_data[0][1])
+                msg = BytesParser(policy=policy.default).parsebytes(item[1])
 
                 for part in msg.iter_attachments():
                     filename = part.get_filename()
                     if filename and (filename.endswith('.zip') or filename.endswith('.gz')):
                         attachments.append((filename, part.get_payload(decode=True)))
 
-                # Mark email as seen
-                mail.store(num, '+FLAGS', '\\Seen')
-
-        mail.logout()
-
-    except Exception as e:
-        print(f"Error retrieving emails: {e}")
+            # Mark emails as seen
+            mail.store(batch, '+FLAGS', '\\Seen')
 
     return attachments
 
-def clean_xml(xml_data):
-    """Strips unwanted characters, removes namespaces, and validates XML format."""
-    cleaned_xml = xml_data.replace('\r\n', '').replace('\n', '').strip()
-    
-    # Remove XML namespace definitions
-    cleaned_xml = re.sub(r'xmlns="[^"]+"', '', cleaned_xml)
-
-    # Check if XML is still valid
-    try:
-        ET.fromstring(cleaned_xml)
-        return cleaned_xml  # Return only if valid
-    except ET.ParseError:
-        print("Invalid XML detected. Skipping.")
-        return None  # Skip invalid XMLs
-
-def extract_dmarc_reports():
-    """Extracts DMARC XML reports from email attachments."""
-    xml_reports = []
-    attachments = get_email_attachments()
+def extract_dmarc_reports(filename, file_data):
+    """Decompresses an email attachment and parses the DMARC reports it contains.
 
-    for filename, file_data in attachments:
-        extracted_xml = None
+    Runs in a worker process, so it returns the parsed results rather than
+    touching the Prometheus metrics.
+    """
+    results = []
 
+    # Stream decompressed XML straight into the parser rather than reading
+    # whole reports into memory first
+    try:
         if filename.endswith('.zip'):
             with zipfile.ZipFile(BytesIO(file_data), 'r') as zf:
                 for name in zf.namelist():
                     if name.endswith('.xml'):
                         with zf.open(name) as xml_file:
-                            extracted_xml = xml_file.read().decode('utf-8')
+                            results.append(parse_dmarc_report(xml_file))
 
         elif filename.endswith('.gz'):
             with gzip.open(BytesIO(file_data), 'rb') as gz_file:
-                extracted_xml = gz_file.read().decode('utf-8')
+                results.append(parse_dmarc_report(gz_file))
 
-        if extracted_xml:
-            cleaned_xml = clean_xml(extracted_xml)
-            if cleaned_xml:
-                xml_reports.append(cleaned_xml)
+    except Exception as e:
+        # Log and skip: the email is already marked seen, and an error raised
+        # here would drop every other attachment fetched in this cycle
+        print(f"Error extracting {filename}: {e}")
 
-    return xml_reports
+    return [result for result in results if result is not None]
 
 
-def parse_dmarc_report(xml_data):
-    """Parses a single DMARC XML report and updates Prometheus metrics."""
-    try:
-        root = ET.fromstring(xml_data)
+def _metric_children(domain, provider, report_id, report_date):
+    """Returns the passed, failed, and timestamp metrics bound to a report's labels."""
+    labels = dict(domain=domain, provider=provider, report_id=report_id, report_date=report_date)
+    return (
+        dmarc_passed.labels(**labels),
+        dmarc_failed.labels(**labels),
+        dmarc_last_processed_timestamp_seconds.labels(**labels),
+    )
 
-        # Extract domain, provider, report ID, and date
-        report_metadata = root.find('.//report_metadata')
-        org_name = report_metadata.find('org_name').text if report_metadata.find('org_name') is not None else "unknown"
-        report_id = report_metadata.find('report_id').text if report_metadata.find('report_id') is not None else "unknown"
-        date_range = report_metadata.find('date_range')
-        report_date = time.strftime('%Y-%m-%d', time.gmtime(int(date_range.find('begin').text))) if date_range is not None else "unknown"
-        domain = root.find('.//policy_published/domain').text if root.find('.//policy_published/domain') is not None else "unknown"
+def _text(parent, path, default="unknown"):
+    """Returns the text of the element at path under parent, or default if missing."""
+    elem = parent.find(path)
+    return elem.text if elem is not None else default
 
-        passed_count = 0
-        failed_count = 0
+def parse_dmarc_report(xml_file):
+    """Parses a single DMARC XML report from a binary file object.
 
-        for record in root.findall('.//record'):
-            count = int(record.find('./row/count').text)
-            disposition = record.find('./row/policy_evaluated/disposition').text
+    Returns a (domain, provider, report_id, report_date, passed, failed) tuple,
+    or None if the report could not be parsed.
+    """
+    org_name = report_id = report_date = domain = "unknown"
+    passed_count = 0
+    failed_count = 0
 
-            if disposition in ['none', 'quarantine']:
-                passed_count += count
-            else:
-                failed_count += count
+    try:
+        # Walk the report once, handling each section as it is closed.
+        # report_metadata and policy_published precede the records.
+        # Only the three sections of interest are reported back from lxml,
+        # matched by local name so namespaced reports work as-is.
+        # Reports arrive from anyone who can email the inbox, so never
+        # resolve entities or fetch DTDs.
+        for _, elem in ET.iterparse(xml_file, events=('end',), tag=REPORT_TAGS,
+                                    resolve_entities=False, no_network=True, load_dtd=False):
+            tag = elem.tag.rpartition('}')[2]
+
+            if tag == 'report_metadata':
+                # Extract provider, report ID, and date
+                org_name = _text(elem, '{*}org_name')
+                report_id = _text(elem, '{*}report_id')
+                begin = _text(elem, '{*}date_range/{*}begin', None)
+                report_date = time.strftime('%Y-%m-%d', time.gmtime(int(begin))) if begin is not None else "unknown"
+
+            elif tag == 'policy_published':
+                domain = _text(elem, '{*}domain')
+
+            elif tag == 'record':
+                row = elem.find('{*}row')
+                count = int(row.find('{*}count').text)
+                disposition = row.find('{*}policy_evaluated').find('{*}disposition').text
+
+                if disposition in PASSED_DISPOSITIONS:
+                    passed_count += count
+                else:
+                    failed_count += count
+
+                # Drop processed records so memory stays flat on large reports
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+    except ET.XMLSyntaxError:
+        print("Invalid XML detected. Skipping.")
+        return None
+    except (AttributeError, TypeError, ValueError):
+        print("Error parsing DMARC XML")
+        return None
 
-        # Update Prometheus metrics with labels
-        dmarc_passed.labels(domain=domain, provider=org_name, report_id=report_id, report_date=report_date).inc(passed_count)
-        dmarc_failed.labels(domain=domain, provider=org_name, report_id=report_id, report_date=report_date).inc(failed_count)
-        dmarc_last_processed_timestamp_seconds.labels(domain=domain, provider=org_name, report_id=report_id, report_date=report_date).set(time.time())
+    return domain, org_name, report_id, report_date, passed_count, failed_count
 
-        print(f"Updated metrics - Domain: {domain}, Provider: {org_name}, Report ID: {report_id}, Date: {report_date}, Passed: {passed_count}, Failed: {failed_count}")
+def load_processed_reports():
+    """Loads the keys of previously processed reports from the state file, if configured."""
+    path = CONFIG.get("state", {}).get("path")
+    if not path:
+        return set()
 
-    except ET.ParseError:
-        print("Error parsing DMARC XML")
+    try:
+        with open(Path(path), "r", encoding="utf-8") as f:
+            return {line.rstrip("\n") for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+def record_processed_report(key):
+    """Appends a processed report's key to the state file, if configured."""
+    path = CONFIG.get("state", {}).get("path")
+    if not path:
+        return
+
+    # Failing to persist only weakens dedup across restarts, so log and carry on
+    try:
+        with open(Path(path), "a", encoding="utf-8") as f:
+            f.write(f"{key}\n")
+    except OSError as e:
+        print(f"Error recording processed report in {path}: {e}")
+
+def publish_report(result, processed_reports):
+    """Updates Prometheus metrics with a parsed DMARC report, once per report."""
+    domain, org_name, report_id, report_date, passed_count, failed_count = result
+
+    # Counts only ever increase, so replaying a report would double count it
+    if report_id != "unknown":
+        key = f"{org_name}\t{report_id}"
+        if key in processed_reports:
+            print(f"Skipping already processed report - Provider: {org_name}, Report ID: {report_id}")
+            return
+
+        processed_reports.add(key)
+        record_processed_report(key)
+
+    # Update Prometheus metrics with labels
+    passed, failed, last_processed = _metric_children(domain, org_name, report_id, report_date)
+    passed.inc(passed_count)
+    failed.inc(failed_count)
+    last_processed.set(time.time())
+
+    print(f"Updated metrics - Domain: {domain}, Provider: {org_name}, Report ID: {report_id}, Date: {report_date}, Passed: {passed_count}, Failed: {failed_count}")
+
+def new_worker_pool():
+    """Creates the process pool that decompresses and parses attachments."""
+    # Forking directly from this process could copy locks held by the
+    # Prometheus HTTP server thread, so fork workers from a clean server process
+    return concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context("forkserver"))
+
+def process_attachments(executor, attachments, processed_reports):
+    """Parses attachments in the worker pool and publishes their reports.
+
+    Returns the pool to use from now on, which is replaced if a worker died.
+    """
+    futures = [executor.submit(extract_dmarc_reports, filename, file_data)
+               for filename, file_data in attachments]
+
+    retries = []
+    for attachment, future in zip(attachments, futures):
+        try:
+            results = future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            retries.append(attachment)
+            continue
+
+        for result in results:
+            publish_report(result, processed_reports)
+
+    if not retries:
+        return executor
+
+    # A worker died, e.g. killed for memory on a huge report. A broken pool
+    # fails every unfinished task, and their emails are already marked seen,
+    # so retry them one at a time in a new pool to isolate the culprit.
+    print(f"Worker process died; retrying {len(retries)} attachment(s)")
+    executor.shutdown(wait=False, cancel_futures=True)
+    executor = new_worker_pool()
+
+    for filename, file_data in retries:
+        try:
+            results = executor.submit(extract_dmarc_reports, filename, file_data).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            print(f"Dropping attachment {filename}: worker process died while parsing it")
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = new_worker_pool()
+            continue
+
+        for result in results:
+            publish_report(result, processed_reports)
+
+    return executor
 
 def update_metrics():
-    """Periodically fetches new emails, extracts, and updates metrics."""
+    """Fetches new emails as they arrive, extracts, and updates metrics."""
     try:
         interval = CONFIG["prometheus"].get("interval", 60)
     except KeyError:
@@ -166,13 +410,56 @@ def update_metrics():
     if interval < 30:
         print("Warning: Configured interval too low; Setting minimum 30 seconds")
         interval = 30
-    while True:
-        xml_reports = extract_dmarc_reports()
-        if xml_reports:
-            for xml_data in xml_reports:
-                parse_dmarc_report(xml_data)
 
-        time.sleep(interval)
+    processed_reports = load_processed_reports()
+
+    # Decompression and parsing are CPU-bound, so fan attachments out across
+    # cores. Metrics are only updated here since each process has its own.
+    executor = new_worker_pool()
+
+    # One IMAP connection is reused across cycles and only re-established
+    # after an error
+    mail = None
+    try:
+        while True:
+            try:
+                if mail is None:
+                    mail = connect_mailbox()
+                    use_idle = supports_idle(mail)
+
+                # Forget mail announced before this cycle's SEARCH
+                mail.untagged_responses.pop('EXISTS', None)
+
+                attachments = get_email_attachments(mail)
+                if attachments:
+                    executor = process_attachments(executor, attachments, processed_reports)
+
+                # Mail that arrived during this cycle is fetched right away
+                if mail.untagged_responses.pop('EXISTS', None):
+                    continue
+
+                # Wait for the server to push new mail, falling back to
+                # polling when IDLE is unavailable
+                if use_idle:
+                    use_idle = wait_for_mail(mail, IDLE_TIMEOUT)
+                if not use_idle:
+                    time.sleep(interval)
+
+            except (imaplib.IMAP4.abort, OSError) as e:
+                print(f"Lost connection to IMAP server: {e}. Reconnecting in {interval} seconds")
+                close_mailbox(mail)
+                mail = None
+                time.sleep(interval)
+
+            except Exception as e:
+                print(f"Error retrieving emails: {e}")
+                close_mailbox(mail)
+                mail = None
+                time.sleep(interval)
+
+    finally:
+        close_mailbox(mail)
+        executor.shutdown(cancel_futures=True)
 
 
 def main():